@@ -0,0 +1,385 @@
+"""
+This module contains a resident daemon that serves lex, parse and analyze
+requests over a local Unix socket.
+
+Running lexer.py, parser.py or grammar.py directly pays for interpreter
+startup, imports and grammar analysis on every invocation. The daemon does
+that work once: the grammars from grammar.py are analyzed when it starts, and
+lexing and parsing are done by a pool of worker processes that already have
+the lexer and parser loaded.
+
+The protocol is line based. A client sends one JSON object per line, and the
+daemon answers each with one JSON object on a line of its own:
+
+    {"op": "lex", "text": "{\"a\": 1}"}
+    {"op": "parse", "text": "{\"a\": 1}"}
+    {"op": "analyze", "grammar": "grammar_json_6"}
+    {"op": "stats"}
+
+Every response has an "ok" field, and either a "result" or an "error". The
+error starts with the type of the exception that caused it, e.g.
+"SyntaxError: ..." for a document the parser rejects. The "elapsed_ms" field
+holds the time the daemon spent on the request, and the "stats" op returns
+the latency statistics collected for each op so far.
+
+A lex or parse request that takes longer than the daemon's request timeout
+is answered with an error. The pool is then replaced with a new one, which
+stops the worker that is stuck on the document, so later requests are served
+right away. Other lex and parse requests running in the old pool at that
+moment are answered with a timeout error as well.
+
+Each client connection is served by its own thread, so clients do not wait
+for one another, and the lex and parse work is handed to the worker pool so
+it does not hold the interpreter lock of the serving process.
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import SocketServer
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+import grammar
+from lexer import lex
+from parser import parse_quietly
+
+
+DEFAULT_SOCKET_PATH = 'parse_daemon.sock'
+DEFAULT_TIMEOUT = 10.0  # seconds
+
+# the grammars that are analyzed when the daemon starts, by name
+GRAMMAR_NAMES = [
+    'grammar_recitation',
+    'grammar_json_4a',
+    'grammar_json_4b',
+    'grammar_json_4c',
+    'grammar_json_6',
+]
+
+
+class RequestError(Exception):
+    pass
+
+
+def analyze(rules):
+    """
+    Analyze the given grammar, and return a dictionary with its terminals,
+    nonterminals, NULLABLE, FIRST, FOLLOW and SELECT sets, and whether it is
+    LL(1), in a form that can be encoded as JSON.
+
+    This computes the same sets as grammar.analyze_grammar, without printing
+    them.
+    """
+    terminals, nonterminals = grammar.find_terminals_and_nonterminals(rules)
+    nullable = grammar.calculate_nullable(terminals, nonterminals, rules)
+    first = grammar.calculate_first(terminals, nonterminals, rules, nullable)
+    follow = grammar.calculate_follow(terminals, nonterminals, rules, nullable, first)
+    select = grammar.calculate_select(terminals, nonterminals, rules, nullable, first, follow)
+
+    conflicts = []
+    n = len(rules)
+    for i in range(n):
+        for j in range(i+1, n):
+            r1 = rules[i]
+            r2 = rules[j]
+            if r1[0] == r2[0] and len(select[r1] & select[r2]) > 0:
+                conflicts.append([grammar.format_rule(r1), grammar.format_rule(r2)])
+
+    return {
+        'rules': [grammar.format_rule(r) for r in rules],
+        'terminals': sorted(terminals),
+        'nonterminals': sorted(nonterminals),
+        'nullable': sorted(nullable),
+        'first': dict((k, sorted(v)) for k, v in first.items()),
+        'follow': dict((k, sorted(v)) for k, v in follow.items()),
+        'select': dict((grammar.format_rule(k), sorted(v)) for k, v in select.items()),
+        'll1': not conflicts,
+        'conflicts': conflicts,
+    }
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket at socket_path if it was left behind by a daemon that
+    is no longer running. Raise an exception if the path is not a socket, or
+    if a daemon is still listening on it.
+    """
+    try:
+        mode = os.stat(socket_path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception("{} exists and is not a socket".format(socket_path))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except socket.error:
+        os.unlink(socket_path)
+    else:
+        raise Exception("A daemon is already listening on {}".format(socket_path))
+    finally:
+        s.close()
+
+
+def init_worker(listen_fd=None):
+    """
+    Leave signals sent to the daemon's process group (Ctrl-C, or a SIGTERM
+    from a supervisor) to the daemon, which shuts the pool down itself. A
+    worker killed by such a signal while waiting for a task takes the pool's
+    queue lock with it, and the pool then hangs while shutting down.
+
+    The daemon's own SIGTERM handler may have been installed before the worker
+    was started, so it is reset here for the pool to be able to stop the
+    worker.
+
+    A pool created after the daemon's socket was bound passes its listen_fd,
+    which the worker closes, so that a worker left running after the daemon
+    was killed does not keep accepting connections on the socket.
+    """
+    os.setpgrp()
+    if listen_fd is not None:
+        os.close(listen_fd)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def do_lex(text):
+    """
+    Lex the given text. Runs in a worker process.
+    """
+    return lex(text)
+
+
+def do_parse(text):
+    """
+    Lex and parse the given text, and return the parse tree. Runs in a worker
+    process.
+    """
+    return parse_quietly(lex(text))
+
+
+class LatencyStats(object):
+    """
+    Per-op request counts and latencies, shared between the serving threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ops = dict()
+
+    def record(self, op, elapsed_ms, ok):
+        with self.lock:
+            s = self.ops.get(op)
+            if s is None:
+                s = self.ops[op] = {
+                    'count': 0,
+                    'errors': 0,
+                    'total_ms': 0.0,
+                    'min_ms': elapsed_ms,
+                    'max_ms': elapsed_ms,
+                }
+            s['count'] += 1
+            if not ok:
+                s['errors'] += 1
+            s['total_ms'] += elapsed_ms
+            s['min_ms'] = min(s['min_ms'], elapsed_ms)
+            s['max_ms'] = max(s['max_ms'], elapsed_ms)
+
+    def snapshot(self):
+        with self.lock:
+            result = dict()
+            for op, s in self.ops.items():
+                result[op] = dict(s)
+                result[op]['mean_ms'] = s['total_ms'] / s['count']
+            return result
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve the requests sent over a single client connection, one per line,
+    until the client closes it.
+    """
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            response = self.server.serve(line)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class ParseDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    A Unix socket server that keeps the analyzed grammars and a pool of worker
+    processes around between requests.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, processes=None, request_timeout=DEFAULT_TIMEOUT):
+        remove_stale_socket(socket_path)
+        self.request_timeout = request_timeout
+        self.processes = processes
+        self.analyses = dict()
+        for name in GRAMMAR_NAMES:
+            self.analyses[name] = analyze(getattr(grammar, name))
+        # the pool is created before the socket is bound, so the workers do
+        # not inherit it
+        self.pool = multiprocessing.Pool(processes, init_worker)
+        self.pool_lock = threading.Lock()
+        self.stats = LatencyStats()
+        SocketServer.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+
+    def serve(self, line):
+        """
+        Serve a single request given as a line of JSON, and return the
+        response as a dictionary.
+        """
+        start = time.time()
+        op = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise RequestError("Request must be a JSON object")
+            op = request.get('op')
+            result = self.dispatch(op, request)
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            response = {'ok': False, 'error': "{}: {}".format(type(e).__name__, e)}
+        elapsed_ms = (time.time() - start) * 1000
+        response['elapsed_ms'] = elapsed_ms
+        self.stats.record(op if op in ('lex', 'parse', 'analyze', 'stats') else 'invalid',
+                          elapsed_ms, response['ok'])
+        return response
+
+    def dispatch(self, op, request):
+        if op == 'lex':
+            return self.run_in_pool(do_lex, request)
+        elif op == 'parse':
+            return self.run_in_pool(do_parse, request)
+        elif op == 'analyze':
+            name = request.get('grammar', GRAMMAR_NAMES[-1])
+            if name not in self.analyses:
+                raise RequestError("Unknown grammar: {}".format(name))
+            return self.analyses[name]
+        elif op == 'stats':
+            return self.stats.snapshot()
+        else:
+            raise RequestError("Unknown op: {}".format(op))
+
+    def run_in_pool(self, f, request):
+        """
+        Call f on the request's text in a worker, and wait for the result for
+        at most self.request_timeout seconds.
+        """
+        if 'text' not in request:
+            raise RequestError("Missing field: text")
+        text = request['text']
+        if not isinstance(text, basestring):
+            raise RequestError("Field text must be a string")
+        pool = self.pool
+        try:
+            return pool.apply_async(f, (text,)).get(self.request_timeout)
+        except multiprocessing.TimeoutError:
+            self.recycle_pool(pool)
+            raise RequestError("Timed out after {} seconds".format(self.request_timeout))
+
+    def recycle_pool(self, pool):
+        """
+        Replace the given pool with a new one, unless another thread already
+        did, and terminate it along with the work still running in it.
+        """
+        with self.pool_lock:
+            if self.pool is not pool:
+                return
+            self.pool = multiprocessing.Pool(self.processes, init_worker, (self.fileno(),))
+        pool.terminate()
+        pool.join()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        with self.pool_lock:
+            self.pool.terminate()
+            self.pool.join()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def request(message, socket_path=DEFAULT_SOCKET_PATH):
+    """
+    Send a single request (a dictionary) to the daemon listening on
+    socket_path, and return its response.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        f = s.makefile('r+')
+        f.write(json.dumps(message) + '\n')
+        f.flush()
+        return json.loads(f.readline())
+    finally:
+        s.close()
+
+
+def check():
+    """
+    Start a daemon with a short request timeout on a temporary socket, and
+    check that a request made after another one timed out is still answered.
+    """
+    socket_path = os.path.join(tempfile.mkdtemp(), 'parse_daemon.sock')
+    server = ParseDaemon(socket_path, request_timeout=0.5)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        # lexing this takes several seconds
+        response = request({'op': 'lex', 'text': '[' * 100000}, socket_path)
+        print response
+        assert not response['ok'] and 'Timed out' in response['error']
+        for i in range(3):
+            response = request({'op': 'lex', 'text': '{"a": 1}'}, socket_path)
+            print response
+            assert response['ok']
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.rmdir(os.path.dirname(socket_path))
+    print "OK"
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    """
+    Usage: python parse_daemon.py [<socket path> [<request timeout in seconds>]]
+           python parse_daemon.py --check
+    """
+    if sys.argv[1:] == ['--check']:
+        check()
+        return
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET_PATH
+    request_timeout = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TIMEOUT
+    server = ParseDaemon(socket_path, request_timeout=request_timeout)
+    # shut down on SIGTERM the same way as on Ctrl-C; this is done after the
+    # pool is created, since the pool stops its workers with SIGTERM
+    signal.signal(signal.SIGTERM, interrupt)
+    print "Listening on {}".format(socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 This file contains the JSON parser.
 """
 
+import sys
+
 from symbols import *
 
 
@@ -175,6 +177,28 @@ class JsonParser(Parser):
             raise SyntaxError("Syntax error: no rule for token: {}".format(self.t))
 
 
+class NullWriter(object):
+    """
+    A file-like object that discards everything written to it.
+    """
+    def write(self, s):
+        pass
+
+
+def parse_quietly(tokens):
+    """
+    Parse the tokens with a JsonParser, and return the parse tree, without
+    printing the tokens it matches. The lines are still formatted by match,
+    but they are discarded instead of being written or kept.
+    """
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        return JsonParser(tokens).parse()
+    finally:
+        sys.stdout = stdout
+
+
 def main():
     from lexer import lex
     from tree_to_dot import tree_to_dot, view
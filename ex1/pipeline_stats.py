@@ -0,0 +1,312 @@
+"""
+This module runs a document through the whole pipeline (lex, then
+JsonParser.parse, then tree_to_dot) and records, for each stage, its wall
+time, the number of tokens or nodes it handled, its throughput, and its peak
+memory use.
+
+The result is a record (a dictionary that can be encoded as JSON) per
+document, of the form:
+
+    {"document": "json_example.json",
+     "bytes": 712,
+     "wall_time": 0.0027,
+     "stages": [{"stage": "lex", "wall_time": 0.0014, "items": 65,
+                 "unit": "tokens", "items_per_sec": 45197.2,
+                 "peak_memory": 0, "memory_measure": "ru_maxrss",
+                 "error": null},
+                ...],
+     "violations": [],
+     "error": null}
+
+A stage that raises an exception (e.g. a SyntaxError from the parser) ends
+the run. Its stage in the record has no items, and has the exception in its
+"error" field, which is also copied to the "error" field of the record.
+
+Peak memory is measured with resource.getrusage, as the growth of the peak
+resident set size of the whole process during the stage. That depends on
+what ran earlier in the process: it is 0 for any stage that does not take the
+process past its earlier peak, so the same document can report very different
+values on different runs. It is recorded for information only, and budgets
+for it are rejected.
+
+Only tracemalloc measures the memory of a stage by itself, and only its
+measure is checked against peak_memory budgets. tracemalloc is not available
+on Python 2, which this code is written for, so peak_memory budgets cannot
+be used with it.
+
+Budgets limit the wall time and peak memory of each stage, and are given as a
+dictionary mapping a stage name to its limits, for example:
+
+    {"lex": {"wall_time": 0.5}, "parse": {"wall_time": 1.0, "peak_memory": 2**20}}
+
+A stage that exceeds its budget either issues a BudgetWarning, or raises
+BudgetExceeded and stops the pipeline.
+"""
+
+import json
+import re
+import sys
+import warnings
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from lexer import lex
+from parser import parse_quietly
+from tree_to_dot import tree_to_dot
+
+
+STAGES = ['lex', 'parse', 'tree_to_dot']
+METRICS = ['wall_time', 'peak_memory']
+
+# a budget given on the command line, as <stage>.<metric>=<limit>
+budget_regex = '^({})\\.({})=(.*)$'.format('|'.join(STAGES), '|'.join(METRICS))
+
+
+class BudgetWarning(UserWarning):
+    pass
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a stage exceeds its budget. The record collected up to and
+    including that stage is kept in self.record.
+    """
+    def __init__(self, message, record):
+        Exception.__init__(self, message)
+        self.record = record
+
+
+class StageFailed(Exception):
+    pass
+
+
+def count_nodes(tree):
+    """
+    Count the nodes of a parse tree in the format used by tree_to_dot,
+    including the leafs. This uses an explicit stack, so it works on any tree
+    the parser can build.
+    """
+    n = 0
+    stack = [tree]
+    while stack:
+        t = stack.pop()
+        n += 1
+        if type(t) is tuple:
+            stack.extend(t[1])
+    return n
+
+
+def max_rss():
+    """
+    Return the peak resident set size of the process so far, in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(f, *args):
+    """
+    Call f with the given arguments, and return its result (None if it raised
+    an exception) and a dictionary with the wall time it took, its peak memory
+    use in bytes, how the memory was measured, and the exception it raised.
+    """
+    trace = tracemalloc is not None and not tracemalloc.is_tracing()
+    if trace:
+        memory_measure = 'tracemalloc'
+        tracemalloc.start()
+    elif resource is not None:
+        memory_measure = 'ru_maxrss'
+        rss = max_rss()
+    else:
+        memory_measure = None
+    try:
+        result = None
+        error = None
+        start = default_timer()
+        try:
+            result = f(*args)
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+        wall_time = default_timer() - start
+        if trace:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        elif memory_measure is not None:
+            peak_memory = max_rss() - rss
+        else:
+            peak_memory = None
+    finally:
+        if trace:
+            tracemalloc.stop()
+    return result, {
+        'wall_time': wall_time,
+        'peak_memory': peak_memory,
+        'memory_measure': memory_measure,
+        'error': error,
+    }
+
+
+def check_budgets(budgets):
+    """
+    Raise an exception if the budgets name an unknown stage or metric, or a
+    peak_memory budget while tracemalloc is not available to measure it.
+    """
+    for stage, limits in budgets.items():
+        if stage not in STAGES:
+            raise Exception("Unknown stage in budgets: {}".format(stage))
+        for metric in limits:
+            if metric not in METRICS:
+                raise Exception("Unknown metric in budgets: {}".format(metric))
+        if 'peak_memory' in limits:
+            if tracemalloc is None:
+                raise Exception("peak_memory budgets need tracemalloc, which is not available")
+            if tracemalloc.is_tracing():
+                raise Exception("peak_memory budgets need tracemalloc, which is already in use")
+
+
+def check_budget(record, stage, budgets, fail):
+    """
+    Check the last stage of the record against its budget, and add any
+    violations to the record.
+    """
+    limits = budgets.get(stage['stage'], {})
+    for metric in METRICS:
+        limit = limits.get(metric)
+        if limit is None or stage[metric] is None or stage[metric] <= limit:
+            continue
+        if metric == 'peak_memory' and stage['memory_measure'] != 'tracemalloc':
+            continue
+        message = "Stage {} of {} exceeded its {} budget: {} > {}".format(
+            stage['stage'], record['document'], metric, stage[metric], limit)
+        record['violations'].append({
+            'stage': stage['stage'],
+            'metric': metric,
+            'value': stage[metric],
+            'limit': limit,
+        })
+        if fail:
+            raise BudgetExceeded(message, record)
+        warnings.warn(message, BudgetWarning)
+
+
+def run_pipeline(text, document=None, budgets=None, fail=False):
+    """
+    Lex and parse the given text, and convert the parse tree to dot.
+    Return the dot (None if a stage failed), and the record of the run.
+
+    budgets maps stage names to their limits, as explained above. If fail is
+    True, a stage that exceeds its budget raises BudgetExceeded, otherwise it
+    issues a BudgetWarning.
+    """
+    budgets = budgets or {}
+    check_budgets(budgets)
+    record = {
+        'document': document,
+        'bytes': len(text),
+        'wall_time': 0.0,
+        'stages': [],
+        'violations': [],
+        'error': None,
+    }
+
+    def run_stage(name, unit, count, f, *args):
+        """
+        Run a single stage, add it to the record, and return its result and
+        the number of items it handled. Raise StageFailed if it failed.
+
+        The items are counted as part of the measured call, so a failure to
+        count them fails the stage too.
+        """
+        def call():
+            result = f(*args)
+            return result, count(result)
+        out, stage = measure(call)
+        result, items = out if stage['error'] is None else (None, None)
+        stage['stage'] = name
+        stage['items'] = items
+        stage['unit'] = unit
+        if items is not None and stage['wall_time'] > 0:
+            stage['items_per_sec'] = items / stage['wall_time']
+        else:
+            stage['items_per_sec'] = None
+        record['stages'].append(stage)
+        record['wall_time'] += stage['wall_time']
+        if stage['error'] is not None:
+            record['error'] = stage['error']
+        check_budget(record, stage, budgets, fail)
+        if stage['error'] is not None:
+            raise StageFailed()
+        return result, items
+
+    try:
+        tokens, _ = run_stage('lex', 'tokens', len, lex, text)
+        tree, nodes = run_stage('parse', 'nodes', count_nodes, parse_quietly, tokens)
+        dot, _ = run_stage('tree_to_dot', 'nodes', lambda dot: nodes, tree_to_dot, tree)
+    except StageFailed:
+        return None, record
+    return dot, record
+
+
+def parse_budget(s):
+    """
+    Parse a budget given on the command line as <stage>.<metric>=<limit>,
+    e.g. parse.wall_time=0.5, and return (stage, metric, limit), or None if
+    s is not a budget.
+    """
+    m = re.match(budget_regex, s)
+    if not m:
+        return None
+    stage, metric, limit = m.groups()
+    try:
+        limit = float(limit)
+    except ValueError:
+        raise Exception("Bad budget: {}".format(s))
+    return stage, metric, limit
+
+
+def main():
+    """
+    Run the pipeline on the files given on the command line, and print a
+    record per file as a line of JSON. Exit with status 1 if the pipeline
+    failed on any file, or, with --fail, if any file exceeded its budget.
+
+    Usage: python pipeline_stats.py [--fail] [<stage>.<metric>=<limit> ...] <file> ...
+    """
+    fail = False
+    budgets = dict()
+    filenames = []
+    for arg in sys.argv[1:]:
+        budget = parse_budget(arg)
+        if arg == '--fail':
+            fail = True
+        elif budget is not None:
+            stage, metric, limit = budget
+            budgets.setdefault(stage, dict())[metric] = limit
+        else:
+            filenames.append(arg)
+
+    failed = False
+    for filename in filenames:
+        text = open(filename).read()
+        try:
+            dot, record = run_pipeline(text, filename, budgets, fail)
+        except BudgetExceeded as e:
+            record = e.record
+        if record['error'] is not None or (fail and record['violations']):
+            failed = True
+        print json.dumps(record)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()